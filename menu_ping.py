@@ -1,24 +1,49 @@
 #!/opt/homebrew/bin/python3.10
 """Menu bar ping monitor for macOS."""
 
+import asyncio
+import ipaddress
+import math
 import os
 import plistlib
+import random
+import re
+import socket
+import struct
 import subprocess
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 import rumps
 from AppKit import (
-    NSAttributedString, NSFont, NSColor, NSImage, NSBezierPath, NSRect,
+    NSAttributedString, NSFont, NSColor, NSImage, NSRect,
     NSForegroundColorAttributeName, NSFontAttributeName,
-    NSMakeSize, NSMakeRect,
+    NSMakeSize,
 )
-from Foundation import NSSize
+from CoreText import (
+    CTLineCreateWithAttributedString, CTLineDraw,
+    kCTForegroundColorFromContextAttributeName,
+)
+from Foundation import NSBundle, NSSize
+from Quartz import (
+    CGBitmapContextCreate, CGBitmapContextCreateImage, CGColorSpaceCreateDeviceRGB,
+    CGContextAddPath, CGContextFillPath, CGContextScaleCTM,
+    CGContextSetFillColorWithColor, CGContextSetTextPosition,
+    CGPathCreateWithRoundedRect, CGRectMake, kCGImageAlphaPremultipliedLast,
+)
+from PyObjCTools import AppHelper
 
 DEFAULT_HOST = "8.8.8.8"
 DEFAULT_GOOD = 100    # ms — green threshold
 DEFAULT_WARN = 200    # ms — yellow threshold
 PING_INTERVAL = 2     # seconds
+PING_TOLERANCE = 0.5  # seconds of slack macOS may use to coalesce our wakeups
+RESOLVE_TTL = 300     # seconds before a custom hostname is looked up again
+RESOLVE_RETRY = 30    # minimum seconds between lookups while pings are failing
 BUNDLE_ID = "com.oscar.menuping"
 LAUNCH_AGENT_PATH = os.path.expanduser(f"~/Library/LaunchAgents/{BUNDLE_ID}.plist")
+LAUNCH_AGENT_DIR = os.path.dirname(LAUNCH_AGENT_PATH)
 
 HOSTS = [
     ("Google DNS — 8.8.8.8", "8.8.8.8"),
@@ -34,64 +59,220 @@ THRESHOLD_PRESETS = [
     ("Relaxed (200 / 500 ms)", 200, 500),
 ]
 
-BG_COLORS = {
-    "red":    NSColor.colorWithSRGBRed_green_blue_alpha_(0.85, 0.15, 0.15, 1.0),
-    "yellow": NSColor.colorWithSRGBRed_green_blue_alpha_(0.90, 0.65, 0.0, 1.0),
-    "green":  NSColor.colorWithSRGBRed_green_blue_alpha_(0.15, 0.70, 0.15, 1.0),
-}
+COLOR_RED, COLOR_YELLOW, COLOR_GREEN = 0, 1, 2
+BG_COLORS = (
+    NSColor.colorWithSRGBRed_green_blue_alpha_(0.85, 0.15, 0.15, 1.0),  # COLOR_RED
+    NSColor.colorWithSRGBRed_green_blue_alpha_(0.90, 0.65, 0.0, 1.0),   # COLOR_YELLOW
+    NSColor.colorWithSRGBRed_green_blue_alpha_(0.15, 0.70, 0.15, 1.0),  # COLOR_GREEN
+)
 FG_COLOR = NSColor.whiteColor()
 FONT = NSFont.monospacedDigitSystemFontOfSize_weight_(11, 0.6)
+_ATTRS = {
+    NSForegroundColorAttributeName: FG_COLOR,
+    NSFontAttributeName: FONT,
+    kCTForegroundColorFromContextAttributeName: True,
+}
 
 
 def _measure_text(text):
-    attrs = {NSForegroundColorAttributeName: FG_COLOR, NSFontAttributeName: FONT}
-    s = NSAttributedString.alloc().initWithString_attributes_(text, attrs)
+    s = NSAttributedString.alloc().initWithString_attributes_(text, _ATTRS)
     return s.size()
 
 # Pre-compute a fixed badge width from the widest expected label
 _max_size = _measure_text("9999ms")
+# Digits are monospaced, so "<n>ms" labels can be measured without text layout
+_DIGIT_W = _measure_text("0").width
+_MS_W = _measure_text("ms").width
 BADGE_PAD_X, BADGE_PAD_Y = 6, 2
 BADGE_W = _max_size.width + BADGE_PAD_X * 2
 BADGE_H = _max_size.height + BADGE_PAD_Y * 2
+BADGE_SCALE = 2   # draw at Retina resolution; AppKit downsamples on 1x displays
+_RGB = CGColorSpaceCreateDeviceRGB()
 
 
-def make_badge_image(text, color_name):
-    """Create a fixed-width rounded-rect badge image with colored bg and white text."""
-    attrs = {
-        NSForegroundColorAttributeName: FG_COLOR,
-        NSFontAttributeName: FONT,
-    }
-    attr_str = NSAttributedString.alloc().initWithString_attributes_(text, attrs)
-    text_size = attr_str.size()
+def make_badge_image(text, color):
+    """Create a fixed-width rounded-rect badge image with colored bg and white text.
+
+    Drawn straight into a CGBitmapContext rather than through NSImage.lockFocus.
+    """
+    attr_str = NSAttributedString.alloc().initWithString_attributes_(text, _ATTRS)
+    if text[:-2].isdigit():
+        text_w = (len(text) - 2) * _DIGIT_W + _MS_W
+    else:
+        text_w = attr_str.size().width
 
     w = BADGE_W
     h = BADGE_H
 
-    img = NSImage.alloc().initWithSize_(NSMakeSize(w, h))
-    img.lockFocus()
+    ctx = CGBitmapContextCreate(
+        None, math.ceil(w * BADGE_SCALE), math.ceil(h * BADGE_SCALE), 8, 0, _RGB,
+        kCGImageAlphaPremultipliedLast,
+    )
+    CGContextScaleCTM(ctx, BADGE_SCALE, BADGE_SCALE)
+
+    CGContextSetFillColorWithColor(ctx, BG_COLORS[color].CGColor())
+    path = CGPathCreateWithRoundedRect(CGRectMake(0, 0, w, h), 4, 4, None)
+    CGContextAddPath(ctx, path)
+    CGContextFillPath(ctx)
+
+    # CoreText draws from the baseline, not the bottom of the line box
+    CGContextSetFillColorWithColor(ctx, FG_COLOR.CGColor())
+    x = (w - text_w) / 2
+    CGContextSetTextPosition(ctx, x, BADGE_PAD_Y - FONT.descender())
+    CTLineDraw(CTLineCreateWithAttributedString(attr_str), ctx)
+
+    img = NSImage.alloc().initWithCGImage_size_(
+        CGBitmapContextCreateImage(ctx), NSMakeSize(w, h),
+    )
+    img.setTemplate_(False)
+    return img
 
-    bg = BG_COLORS[color_name]
-    bg.setFill()
-    rect = NSMakeRect(0, 0, w, h)
-    path = NSBezierPath.bezierPathWithRoundedRect_xRadius_yRadius_(rect, 4, 4)
-    path.fill()
 
-    x = (w - text_size.width) / 2
-    attr_str.drawAtPoint_((x, BADGE_PAD_Y))
+# `ping -q` prints only the summary, e.g. "round-trip min/avg/max/stddev = 12.3/…";
+# with a single packet the first figure is the RTT
+_PING_RE = re.compile(rb" = ([\d.]+)/")
 
-    img.unlockFocus()
-    img.setTemplate_(False)
-    return img
+
+def _parse_rtt(out):
+    """Return the RTT in ms from `ping -q -c 1` output bytes, or None."""
+    m = _PING_RE.search(out)
+    return float(m.group(1)) if m else None
+
+
+def _badge_key(ms, warn_ms):
+    """Map a ping result to its (rounded ms, COLOR_*) badge key."""
+    if ms is None:
+        return (None, COLOR_RED)
+    return (round(ms), COLOR_YELLOW if ms > warn_ms else COLOR_GREEN)
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+# <sys/socket.h> on macOS; neither is exported by the socket module
+SO_TIMESTAMP = 0x0400   # setsockopt option
+SCM_TIMESTAMP = 0x02    # type of the control message it produces
+
+
+def _icmp_checksum(data):
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+class Pinger:
+    """ICMP echo over an unprivileged SOCK_DGRAM socket, timed by the kernel.
+
+    Receive times come from the SO_TIMESTAMP control message instead of a
+    clock read in Python, so loop scheduling and GIL jitter stay out of the RTT.
+    Any number of probes can be in flight on the one socket; replies are
+    matched back to their probe by (id, seq).
+    Raises PermissionError where unprivileged ICMP sockets aren't allowed.
+    """
+
+    def __init__(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+        self._sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMP, 1)
+        self._sock.setblocking(False)
+        self._id = os.getpid() & 0xFFFF
+        self._seq = 0
+        self._waiting = {}    # (id, seq) -> future resolved with the receive time
+        self._reading = False
+
+    async def ping(self, addr, timeout=2):
+        """Return the round-trip time to an IPv4 address in ms, or None on timeout."""
+        loop = asyncio.get_running_loop()
+        if not self._reading:
+            loop.add_reader(self._sock, self._on_readable)
+            self._reading = True
+
+        self._seq = seq = (self._seq + 1) & 0xFFFF
+        key = (self._id, seq)
+        fut = self._waiting[key] = loop.create_future()
+        try:
+            sent = time.time()
+            self._sock.sendto(self._echo_request(seq), (addr, 0))
+            received = await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._waiting.pop(key, None)
+        # Both ends are wall-clock times, so a clock step can make this negative
+        return max(0.0, (received - sent) * 1000)
+
+    async def ping_many(self, addrs, timeout=2, spread=0.25):
+        """Probe several addresses at once; returns {addr: ms or None}.
+
+        Each send is delayed by a random offset of up to spread seconds so the
+        requests don't all leave in one burst.
+        """
+        async def probe(addr):
+            await asyncio.sleep(random.uniform(0, spread))
+            return await self.ping(addr, timeout)
+
+        results = await asyncio.gather(*map(probe, addrs), return_exceptions=True)
+        return {a: None if isinstance(r, Exception) else r for a, r in zip(addrs, results)}
+
+    def _echo_request(self, seq):
+        payload = b"menu-ping".ljust(32, b"\0")
+        header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, self._id, seq)
+        checksum = _icmp_checksum(header + payload)
+        return struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, checksum, self._id, seq) + payload
+
+    def _on_readable(self):
+        while True:
+            try:
+                data, ancdata, _, _ = self._sock.recvmsg(1500, socket.CMSG_SPACE(16))
+            except BlockingIOError:
+                return
+            received = None
+            for level, kind, cdata in ancdata:
+                if level == socket.SOL_SOCKET and kind == SCM_TIMESTAMP:
+                    sec, usec = struct.unpack_from("@qi", cdata)  # struct timeval
+                    received = sec + usec / 1e6
+            if received is None:
+                received = time.time()
+
+            # macOS hands DGRAM ICMP sockets the IP header as well
+            if data and data[0] >> 4 == 4:
+                data = data[(data[0] & 0x0F) * 4:]
+            if len(data) < 8:
+                continue
+            kind, _, _, ident, seq = struct.unpack_from("!BBHHH", data)
+            if kind != ICMP_ECHO_REPLY:
+                continue
+            fut = self._waiting.get((ident, seq))
+            if fut is not None and not fut.done():
+                fut.set_result(received)
+
+
+def _resolve(host):
+    """Return host as an IPv4 address string, looking it up if it's a name."""
+    try:
+        return str(ipaddress.IPv4Address(host))
+    except ValueError:
+        infos = socket.getaddrinfo(host, None, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        return infos[0][4][0]
 
 
 class PingApp(rumps.App):
     def __init__(self):
         super().__init__("Ping", quit_button=None)
         self.host = DEFAULT_HOST
+        # (name, address to ping, monotonic time of the lookup or None for IPs),
+        # swapped as a whole so the ping loop never sees a half-updated target
+        self._target = (DEFAULT_HOST, DEFAULT_HOST, None)
+        self._last_lookup = 0.0  # monotonic time of the last lookup attempt
         self.good_ms = DEFAULT_GOOD
         self.warn_ms = DEFAULT_WARN
         self.running = True
-        self._pending_result = None
+
+        # Rendered badges keyed by (rounded ms, COLOR_*); ms is None for "Err".
+        # The label space is small and bounded by the ping timeout, so each
+        # image is drawn once on first use and then reused for good.
+        self._badges = {(None, COLOR_RED): make_badge_image("Err", COLOR_RED)}
+        self._last_badge = None
 
         # --- build menu ---
         # Target submenu
@@ -124,6 +305,7 @@ class PingApp(rumps.App):
         # Start at Login toggle
         self.login_item = rumps.MenuItem("Start at Login", callback=self._toggle_login)
         self.login_item.state = os.path.exists(LAUNCH_AGENT_PATH)
+        self._app_path = self._get_app_path()
 
         self.menu = [
             target_menu, thresh_menu, rumps.separator,
@@ -134,63 +316,114 @@ class PingApp(rumps.App):
             rumps.MenuItem("Quit", callback=self._quit),
         ]
 
-        # Single timer drives everything: kick off ping in bg, apply result on main thread
-        self._ping_in_flight = False
+        # One long-lived asyncio loop on a daemon thread does all the network I/O;
+        # results are handed back to the main thread with AppHelper.callAfter
+        self._loop = asyncio.new_event_loop()
+        # Blocking work (the /sbin/ping fallback, DNS refreshes) runs one at a
+        # time under _ping_lock, so a single reused worker thread is enough
+        self._loop.set_default_executor(ThreadPoolExecutor(max_workers=1))
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        self._ping_lock = asyncio.Lock()
+        try:
+            self._pinger = Pinger()
+        except OSError:
+            self._pinger = None  # no unprivileged ICMP here — use /sbin/ping
+            self._devnull = open(os.devnull, "wb")
+
+        # Single timer drives everything: schedule a ping on the loop every interval
+        # Start at a random phase so we don't wake in lockstep with other
+        # periodic menu bar apps launched at the same moment
         self._timer = rumps.Timer(self._tick, PING_INTERVAL)
+        AppHelper.callLater(random.uniform(0, PING_INTERVAL), self._start_timer)
+
+    def _start_timer(self):
         self._timer.start()
+        self._timer._nstimer.setTolerance_(PING_TOLERANCE)
 
     # ---- ping logic ----
 
-    @staticmethod
-    def _ping(host):
+    async def _ping(self, addr):
+        """Return the round-trip time to addr in ms, or None on failure."""
+        if self._pinger is None:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self._ping_subprocess, addr)
         try:
-            out = subprocess.run(
-                ["ping", "-c", "1", "-W", "2000", host],
-                capture_output=True, text=True, timeout=5,
-            )
-            for line in out.stdout.splitlines():
-                if "time=" in line:
-                    part = line.split("time=")[1]
-                    return float(part.split()[0])
+            return await self._pinger.ping(addr, timeout=2)
         except Exception:
-            pass
-        return None
+            return None
+
+    def _ping_subprocess(self, host):
+        # Only stdout is piped, and close_fds=False skips walking the fd table
+        # in the child — most of the cost of spawning a one-packet ping
+        try:
+            proc = subprocess.Popen(
+                ["/sbin/ping", "-c", "1", "-W", "2000", "-q", host],
+                stdout=subprocess.PIPE, stderr=self._devnull, close_fds=False,
+            )
+        except OSError:
+            return None
+        try:
+            out, _ = proc.communicate(timeout=5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            return None
+        return _parse_rtt(out)
 
     def _tick(self, _):
         """Fires on main thread every PING_INTERVAL seconds."""
-        if self._ping_in_flight:
-            return
-        self._ping_in_flight = True
-        t = threading.Thread(target=self._bg_ping, daemon=True)
-        t.start()
-
-    def _bg_ping(self):
-        """Runs ping in background, then updates UI on main thread."""
-        ms = self._ping(self.host)
-
-        if ms is None:
-            text, color = "Err", "red"
-        elif ms > self.warn_ms:
-            text, color = f"{ms:.0f}ms", "yellow"
-        else:
-            text, color = f"{ms:.0f}ms", "green"
-
-        self._pending_badge = (text, color)
-        self._ping_in_flight = False
+        asyncio.run_coroutine_threadsafe(self._bg_ping(), self._loop)
 
-    @rumps.timer(0.3)
-    def _apply_badge(self, _):
-        """Fast main-thread poller to apply badge as soon as result is ready."""
-        badge_data = getattr(self, "_pending_badge", None)
-        if badge_data is None:
+    async def _bg_ping(self):
+        """Runs ping on the background loop, then updates UI on main thread."""
+        if self._ping_lock.locked():
             return
-        text, color = badge_data
-        self._pending_badge = None
+        async with self._ping_lock:
+            host, addr, resolved_at = self._target
+            if self._lookup_due(resolved_at, RESOLVE_TTL):
+                addr = await self._refresh_target(host) or addr
+            ms = await self._ping(addr)
+            # Post the result before any lookup so an outage turns the badge red now
+            AppHelper.callAfter(self._apply_badge, _badge_key(ms, self.warn_ms))
+            if ms is None and self._lookup_due(resolved_at, 0):
+                await self._refresh_target(host)  # the name may point elsewhere now
+
+    def _lookup_due(self, resolved_at, max_age):
+        """Whether a hostname target is older than max_age and may be looked up again."""
+        if resolved_at is None:
+            return False  # literal IP, nothing to look up
+        now = time.monotonic()
+        return now - resolved_at > max_age and now - self._last_lookup > RESOLVE_RETRY
+
+    async def _refresh_target(self, host):
+        """Look host up again; returns the new address, or None if that failed."""
+        loop = asyncio.get_running_loop()
+        self._last_lookup = time.monotonic()
+        try:
+            addr = await loop.run_in_executor(None, _resolve, host)
+        except (OSError, UnicodeError):
+            return None  # keep pinging the last good address
+        if self._target[0] == host:  # unless the user picked another target meanwhile
+            self._target = (host, addr, time.monotonic())
+        return addr
+
+    def _badge(self, key):
+        """Return the badge image for key, rendering it on first use."""
+        badge = self._badges.get(key)
+        if badge is None:
+            ms, color = key
+            badge = self._badges[key] = make_badge_image(f"{ms}ms", color)
+        return badge
+
+    def _apply_badge(self, key):
+        """Main-thread half of _bg_ping: swap in the new badge image."""
+        if key == self._last_badge:
+            return  # unchanged — don't make AppKit redraw the status item
         try:
             status_item = self._nsapp.nsstatusitem
-            badge = make_badge_image(text, color)
-            status_item.setImage_(badge)
+            status_item.setImage_(self._badge(key))
             status_item.setTitle_("")
+            self._last_badge = key
         except AttributeError:
             pass
 
@@ -198,6 +431,7 @@ class PingApp(rumps.App):
 
     def _set_target(self, sender):
         self.host = sender._ip
+        self._target = (sender._ip, sender._ip, None)
         for item in self.target_items.values():
             item.state = False
         sender.state = True
@@ -211,7 +445,15 @@ class PingApp(rumps.App):
         )
         r = w.run()
         if r.clicked and r.text.strip():
-            self.host = r.text.strip()
+            host = r.text.strip()
+            try:
+                addr = _resolve(host)
+            except (OSError, UnicodeError):
+                rumps.alert(title="Custom Target", message=f"Could not resolve {host}.")
+                return
+            self.host = host
+            self._last_lookup = time.monotonic()
+            self._target = (host, addr, None if addr == host else self._last_lookup)
             for item in self.target_items.values():
                 item.state = False
 
@@ -244,12 +486,11 @@ class PingApp(rumps.App):
     @staticmethod
     def _get_app_path():
         """Return the path to the running .app bundle, or None."""
-        p = os.path.abspath(__file__)
-        while p != "/":
-            if p.endswith(".app"):
-                return p
-            p = os.path.dirname(p)
-        return None
+        # When run as a plain script the main bundle is Python.app, not ours
+        bundle = NSBundle.mainBundle()
+        if bundle.bundleIdentifier() != BUNDLE_ID:
+            return None
+        return str(bundle.bundlePath())
 
     def _toggle_login(self, sender):
         if sender.state:
@@ -261,7 +502,7 @@ class PingApp(rumps.App):
             sender.state = False
         else:
             # Create launch agent
-            app_path = self._get_app_path()
+            app_path = self._app_path
             if app_path is None:
                 rumps.alert(
                     title="Start at Login",
@@ -274,7 +515,7 @@ class PingApp(rumps.App):
                 "ProgramArguments": ["/usr/bin/open", app_path],
                 "RunAtLoad": True,
             }
-            os.makedirs(os.path.dirname(LAUNCH_AGENT_PATH), exist_ok=True)
+            Path(LAUNCH_AGENT_DIR).mkdir(parents=True, exist_ok=True)
             with open(LAUNCH_AGENT_PATH, "wb") as f:
                 plistlib.dump(plist, f)
             sender.state = True
@@ -292,6 +533,7 @@ class PingApp(rumps.App):
 
     def _quit(self, _):
         self.running = False
+        self._loop.call_soon_threadsafe(self._loop.stop)
         rumps.quit_application()
 
 